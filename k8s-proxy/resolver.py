@@ -12,54 +12,189 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import socket
-from copy import deepcopy
-from typing import Callable, List, Tuple, Optional, Union
+import os
+import time
+from copy import copy
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Tuple, Optional, Union
 
 from twisted.internet import defer
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.logger import Logger
 from twisted.names import client, dns, error
-from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
+
+# Logging every query is too slow and noisy for a busy pod, so it has to be
+# asked for:
+DEBUG = "DEBUG_RESOLVER" in os.environ
+
+log = Logger("Resolver")
 
 DNSQueryResult = Union[defer.Deferred, Tuple[List[dns.RRHeader], List, List]]
 
+# Bounds, in seconds, on how long LocalResolver keeps answers cached:
+CACHE_MIN_TTL = 60
+CACHE_MAX_TTL = 24 * 60 * 60
+# How long, in seconds, a name that doesn't exist, or whose nameserver
+# failed, is remembered as such:
+NEGATIVE_CACHE_TTL = 60
+# Maximum number of cached answers. When it's hit, expired answers are
+# purged along with enough of the oldest ones to make room for this many more,
+# so the cache is only scanned once every so many new entries:
+CACHE_MAX_ENTRIES = 10000
+CACHE_PURGE_ENTRIES = 1000
+# Fraction of its TTL after which a cached answer that's used is refreshed in
+# the background, so hot names don't wait on the nameserver when it expires:
+CACHE_REFRESH_AGE = 0.8
+
+# Cached in place of an answer for names that don't exist, and for names
+# whose nameserver failed (SERVFAIL) respectively:
+_NXDOMAIN = object()
+_SERVFAIL = object()
+
+CacheKey = Tuple[int, bytes]
+
+# Marks the end of a suffix in LocalResolver's suffix trie, whose other keys
+# are all labels (bytes):
+_SUFFIX_END = None
+
+# How long, in seconds, Kube DNS gets to answer before the fallback
+# nameserver is asked as well:
+FALLBACK_DELAY = 0.05
+
+HOSTS_PATH = "/etc/hosts"
+RESOLV_CONF_PATH = "/etc/resolv.conf"
+
 
 def insort(target_list, new_element, key):
     """
     Insert ``new_element`` into ``target_list`` while maintaining the sort
     order of ``target_list`` (as defined by ``key``), assuming ``target_list``
     is already sorted.
+
+    Like ``bisect.insort_right``, but with a ``key``; ``new_element`` goes
+    after any existing elements with an equal key.
     """
-    # Since target_list is sorted we could do a binary search.  Good
-    # first-time contribution for a new Telepresence contributor, perhaps...
+    new_key = key(new_element)
+    low, high = 0, len(target_list)
+    while low < high:
+        middle = (low + high) // 2
+        if new_key < key(target_list[middle]):
+            high = middle
+        else:
+            low = middle + 1
+    target_list.insert(low, new_element)
 
-    if not target_list:
-        target_list.append(new_element)
-        return
 
-    new_key = key(new_element)
-    for i, existing_element in enumerate(target_list):
-        if key(existing_element) > new_key:
-            target_list.insert(i, new_element)
-            return
+def clone_query(query: dns.Query, name: bytes) -> dns.Query:
+    """
+    Return a copy of ``query`` for ``name``.
 
-    target_list.append(new_element)
+    This is much cheaper than ``deepcopy()``-ing the query and renaming it.
+    """
+    return dns.Query(name, type=query.type, cls=query.cls)
 
 
-def resolve(hostname: str) -> List[str]:
-    """Do A record lookup, return list of IPs."""
-    return socket.gethostbyname_ex(hostname)[2]
+def unshared(d: defer.Deferred) -> defer.Deferred:
+    """
+    Return a Deferred for the result of ``d``, which can be cancelled without
+    cancelling ``d``.
+
+    ``client.Resolver`` gives everyone looking up the same name at the same
+    time the same lookup, so cancelling it would fail all of them.
+    """
+    result = defer.Deferred()  # type: defer.Deferred
+    d.chainDeferred(result)
+    return result
+
+
+@lru_cache(maxsize=1)
+def _read_resolv_conf(
+    mtime_ns: int
+) -> Tuple[Tuple[str, ...], Tuple[bytes, ...], int]:
+    """
+    Parse /etc/resolv.conf, returning its nameserver IPs, search domains and
+    ndots option.
+
+    Results are cached by the file's modification time, so the file is only
+    parsed again once it's been changed.
+    """
+    nameservers = []  # type: List[str]
+    search = ()  # type: Tuple[bytes, ...]
+    ndots = 1
+    with open(RESOLV_CONF_PATH) as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            keyword = parts[0].lower()
+            if keyword == 'nameserver' and len(parts) >= 2:
+                nameservers.append(parts[1])
+            elif keyword in ('domain', 'search') and len(parts) >= 2:
+                # Like libc, the last domain or search line wins:
+                search = tuple(
+                    part.lower().rstrip(".").encode("ascii")
+                    for part in parts[1:] if part.rstrip(".")
+                )
+            elif keyword == 'options':
+                for option in parts[1:]:
+                    if option.startswith('ndots:'):
+                        try:
+                            ndots = int(option[len('ndots:'):])
+                        except ValueError:
+                            pass
+    return tuple(nameservers), search, ndots
+
+
+def _resolv_conf() -> Tuple[Tuple[str, ...], Tuple[bytes, ...], int]:
+    return _read_resolv_conf(os.stat(RESOLV_CONF_PATH).st_mtime_ns)
+
+
+@lru_cache(maxsize=1)
+def _read_hosts(mtime_ns: int) -> Dict[bytes, Tuple[str, ...]]:
+    """
+    Parse /etc/hosts, returning the IPv4 addresses of each (lowercased) name
+    in it.
+
+    Results are cached by the file's modification time, so the file is only
+    parsed again once it's been changed.
+    """
+    addresses = {}  # type: Dict[bytes, Tuple[str, ...]]
+    with open(HOSTS_PATH, "rb") as f:
+        for line in f:
+            parts = line.split(b"#", 1)[0].split()
+            if len(parts) < 2:
+                continue
+            address = parts[0].decode("ascii", "replace")
+            if not isIPAddress(address):
+                continue
+            for name in parts[1:]:
+                name = name.lower()
+                addresses[name] = addresses.get(name, ()) + (address, )
+    return addresses
+
+
+def get_hosts_addresses(name: bytes) -> Tuple[str, ...]:
+    """Return the IPv4 addresses /etc/hosts has for ``name``."""
+    try:
+        addresses = _read_hosts(os.stat(HOSTS_PATH).st_mtime_ns)
+    except OSError:
+        return ()
+    return addresses.get(name.lower(), ())
 
 
 # XXX duplicated from telepresence
 def get_resolv_conf_namservers() -> List[str]:
     """Return list of namserver IPs in /etc/resolv.conf."""
-    result = []
-    with open("/etc/resolv.conf") as f:
-        for line in f:
-            parts = line.lower().split()
-            if len(parts) >= 2 and parts[0] == 'nameserver':
-                result.append(parts[1])
-    return result
+    return list(_resolv_conf()[0])
+
+
+def get_resolv_conf_search() -> Tuple[List[bytes], int]:
+    """
+    Return the search domains and the ndots option in /etc/resolv.conf.
+    """
+    _, search, ndots = _resolv_conf()
+    return list(search), ndots
 
 
 class LocalResolver(object):
@@ -79,92 +214,410 @@ class LocalResolver(object):
         name.  The elements of the list are names split into separate labels
         (eg ``b"example.invalid"`` becomes ``(b"example", b"invalid")``).  The
         list is maintained in order of longest suffixes to shortest suffixes.
+
+    :ivar dict _inflight: Queries being resolved, or cache entries being
+        refreshed, keyed like ``_cache``. Further queries for the same key
+        wait for them rather than being resolved again.
+
+    :ivar dict _cache: Answers to recent queries, keyed by ``(type, name)``
+        with the name lowercased. Values are ``(expiry, ttl, result,
+        owner)`` where ``expiry`` is a ``time.monotonic()`` timestamp,
+        ``ttl`` is how long the entry was cached for, ``result`` is the
+        answer tuple (or ``_NXDOMAIN`` or ``_SERVFAIL``) and ``owner`` is
+        the name the answers were generated for.
+
+    :ivar int min_ttl: The shortest time, in seconds, an answer is cached
+        for, whatever its records' TTLs.
+
+    :ivar int max_ttl: The longest time, in seconds, an answer is cached for.
     """
 
-    def __init__(self, telepresence_nameserver, namespace):
+    def __init__(self, telepresence_nameserver, namespace, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
         self.noloop = telepresence_nameserver is not None
         self.namespace = namespace
         # The default Twisted client.Resolver *almost* does what we want...
         # except it doesn't support ndots! So we manually deal with A records
-        # and pass the rest on to client.Resolver.
+        # and pass the rest on to client.Resolver. The client.Resolvers are
+        # created once here and every query, including retries without a
+        # search suffix, goes through them:
         if self.noloop:
             self.kubedns = get_resolv_conf_namservers()[0]
+            self._kube_resolver = client.Resolver(
+                servers=[(self.kubedns, 53)], reactor=reactor
+            )
             # We want nameserver that the host machine *doesn't* use so
             # sshuttle doesn't capture packets and cause an infinite query
             # loop:
             self.fallback = client.Resolver(
                 servers=[(telepresence_nameserver, 53)],
+                reactor=reactor,
             )
         else:
-            self.fallback = client.Resolver(resolv='/etc/resolv.conf')
+            self.fallback = client.Resolver(
+                resolv=RESOLV_CONF_PATH, reactor=reactor
+            )
+            self.search, self.ndots = get_resolv_conf_search()
 
         # Suffixes which may be set by resolv.conf search/domain line, which
         # we remove once we figure out what it is.
         self.suffixes = []
+        # The same suffixes, as a trie of their labels in reverse order so
+        # the longest one matching a name is found in a single pass:
+        self._suffix_trie = {}
+
+        self.min_ttl = CACHE_MIN_TTL
+        self.max_ttl = CACHE_MAX_TTL
+        self._cache = {}
+        # Callers waiting on a query or refresh that's already in progress,
+        # with the name each of them asked for:
+        self._inflight = {}
+
+    def close(self) -> None:
+        """
+        Stop the nameserver clients' background work: re-reading
+        resolv.conf, and any TCP connections left open for truncated
+        answers. UDP ports are only open while a query is outstanding.
+        """
+        resolvers = [self.fallback]
+        if self.noloop:
+            resolvers.append(self._kube_resolver)
+        for resolver in resolvers:
+            parse_call = getattr(resolver, "_parseCall", None)
+            if parse_call is not None and parse_call.active():
+                parse_call.cancel()
+            for protocol in resolver.connections:
+                protocol.transport.loseConnection()
 
     def _got_ips(self, name: bytes, ips: List[str],
                  record_type: Callable) -> DNSQueryResult:
         """
         Generate the response to a query, given an IP.
         """
-        print("Result for {!r} is {}".format(name, ips))
+        return self._got_records(
+            name, [record_type(address=ip) for ip in ips]
+        )
+
+    def _got_records(self, name: bytes, records: List) -> DNSQueryResult:
+        """
+        Generate the response to a query, given its records.
+
+        Records decoded from a nameserver's answer are used as they are, with
+        their TTLs, rather than being rebuilt from their IPs.
+        """
+        if DEBUG:
+            log.debug(
+                "Result for {name!r} is {records}", name=name, records=records
+            )
         answers = [
-            dns.RRHeader(name=name, payload=record_type(address=ip))
-            for ip in ips
+            dns.RRHeader(name=name, payload=record, ttl=record.ttl or 0)
+            for record in records
         ]
         authority = []  # type: List
         additional = []  # type: List
         return answers, authority, additional
 
-    def _got_error(self, failure) -> defer.Deferred:
-        if failure.check(socket.gaierror):
-            print("getaddrinfo error: {}".format(failure.getErrorMessage()))
-        return defer.fail(error.DomainError(failure.getErrorMessage()))
+    def _cache_lookup(self, key: CacheKey, query: dns.Query,
+                      real_name: bytes) -> Optional[DNSQueryResult]:
+        """
+        Return the cached result for ``key`` with answers renamed to
+        ``real_name``, or ``None`` if nothing live is cached.
+
+        Answers are returned as they are rather than wrapped in a Deferred;
+        the DNS server handles either.
+
+        An entry that's getting old is refreshed in the background, by
+        resolving ``query`` again.
+        """
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expiry, ttl, result, owner = entry
+        remaining = expiry - time.monotonic()
+        if remaining <= 0:
+            del self._cache[key]
+            return None
+        if (
+            remaining < (1 - CACHE_REFRESH_AGE) * ttl
+            and key not in self._inflight
+        ):
+            self._inflight[key] = []
+            self._reactor.callLater(
+                0, self._refresh, key, clone_query(query, owner)
+            )
+        if result is _NXDOMAIN:
+            return defer.fail(error.DomainError(real_name))
+        if result is _SERVFAIL:
+            return defer.fail(error.DNSServerError(real_name))
+        return self._renamed(result, owner, real_name)
+
+    @staticmethod
+    def _renamed(result, owner: bytes, real_name: bytes):
+        """
+        Return a copy of ``result``, generated for a query of ``owner``, with
+        the answers for ``owner`` renamed to ``real_name``.
+
+        Answers may be shared with other queries and the cache, so nothing
+        may modify their headers or records in place; renaming is done on
+        copies, as here. The copy therefore shares the records and the
+        headers it doesn't rename.
+        """
+        answers, authority, additional = result
+        if owner == real_name:
+            return list(answers), list(authority), list(additional)
+        # Make sure names in response match what the client asked for:
+        name = dns.Name(real_name)
+        renamed = []
+        for answer in answers:
+            if answer.name.name == owner:
+                answer = copy(answer)
+                answer.name = name
+            renamed.append(answer)
+        return renamed, list(authority), list(additional)
+
+    def _wake_waiters(self, result, key: CacheKey, owner: bytes):
+        """
+        Pass the result of an in-progress query on to everyone who asked for
+        the same thing while it was being resolved.
+        """
+        for waiter, real_name in self._inflight.pop(key):
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(self._renamed(result, owner, real_name))
+        return result
+
+    def _cache_store(
+        self, key: CacheKey, ttl: float, result: Any, owner: bytes
+    ) -> None:
+        # Re-insert replaced entries, so the cache stays in the order
+        # entries were stored in:
+        self._cache.pop(key, None)
+        if len(self._cache) >= CACHE_MAX_ENTRIES:
+            now = time.monotonic()
+            live = [item for item in self._cache.items() if item[1][0] > now]
+            keep = CACHE_MAX_ENTRIES - CACHE_PURGE_ENTRIES
+            self._cache = dict(live[max(len(live) - keep, 0):])
+        self._cache[key] = (time.monotonic() + ttl, ttl, result, owner)
+
+    def _cache_result(self, result, key: CacheKey, real_name: bytes):
+        """
+        Callback which caches a successful result for the shortest TTL of
+        its answers, clamped to the cache's TTL bounds.
+        """
+        ttl = min((answer.ttl for answer in result[0]), default=0)
+        ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+        self._cache_store(key, ttl, result, real_name)
+        return result
+
+    def _cache_error(self, failure, key: CacheKey, real_name: bytes):
+        """
+        Errback which remembers names that don't exist, or that the
+        nameserver failed to resolve, for a while. Timeouts aren't cached.
+        """
+        # DNSServerError is a DomainError too, so check for it first:
+        if failure.check(error.DNSServerError):
+            self._cache_store(key, NEGATIVE_CACHE_TTL, _SERVFAIL, real_name)
+        elif failure.check(error.DomainError):
+            self._cache_store(key, NEGATIVE_CACHE_TTL, _NXDOMAIN, real_name)
+        return failure
+
+    def _refresh(self, key: CacheKey, query: dns.Query) -> None:
+        """
+        Resolve ``query`` again and replace the cache entry for ``key`` with
+        the new answer, or with NXDOMAIN if the name no longer exists. If
+        the lookup fails any other way, the entry is left to expire.
+
+        Queries which missed the cache while the refresh was in progress
+        get its result.
+        """
+        name = query.name.name
+
+        def failed(failure):
+            if failure.check(error.DNSNameError):
+                self._cache_store(key, NEGATIVE_CACHE_TTL, _NXDOMAIN, name)
+            elif DEBUG:
+                log.debug(
+                    "Failed to refresh {name!r}: {error}",
+                    name=name,
+                    error=failure.value,
+                )
+            return failure
+
+        if DEBUG:
+            log.debug("REFRESHING {name!r}", name=name)
+        d = defer.maybeDeferred(self._query, query, None, name)
+        d.addCallbacks(self._cache_result, failed, callbackArgs=(key, name))
+        d.addBoth(self._wake_waiters, key, name)
+        # Anyone waiting has been given the failure:
+        d.addErrback(lambda failure: None)
+
+    def _got_error(self, failure) -> Failure:
+        """
+        Log lookup errors other than the name not existing, and pass the
+        failure on as it is, so timeouts aren't mistaken for NXDOMAIN.
+        """
+        if not failure.check(error.DomainError):
+            log.warn("Lookup error: {reason.value}", reason=failure)
+        return failure
+
+    def _search_names(self, name: bytes) -> List[bytes]:
+        """
+        Return the names to look up, in order, to resolve ``name`` the way a
+        client in the pod would, i.e. taking search and ndots into account.
+        """
+        if name.endswith(b"."):
+            return [name[:-1]]
+        expanded = [name + b"." + domain for domain in self.search]
+        if name.count(b".") >= self.ndots:
+            return [name] + expanded
+        return expanded + [name]
+
+    def _lookup_records(
+        self, names: List[bytes], timeout
+    ) -> defer.Deferred:
+        """
+        Look up A records for each of ``names`` in turn until one of them
+        exists, and return its records.
+        """
+
+        def got_answers(result):
+            records = [
+                answer.payload for answer in result[0] if answer.type == dns.A
+            ]
+            if not records:
+                raise error.DNSNameError(names[0])
+            return records
+
+        def next_name(failure):
+            failure.trap(error.DomainError)
+            return self._lookup_records(names[1:], timeout)
+
+        d = self.fallback.lookupAddress(names[0], timeout=timeout)
+        d.addCallback(got_answers)
+        if names[1:]:
+            d.addErrback(next_name)
+        return d
+
+    def _resolve(self, name: bytes, timeout) -> defer.Deferred:
+        """
+        Do A record lookup the way ``gethostbyname()`` would, return list of
+        A records.
+        """
+        records = [
+            dns.Record_A(address=ip) for ip in get_hosts_addresses(name)
+        ]
+        if records:
+            return defer.succeed(records)
+        return self._lookup_records(self._search_names(name), timeout)
 
     def _no_loop_kube_query(
-        self, query: dns.Query, timeout: float, real_name: bytes
+        self,
+        query: dns.Query,
+        timeout: float,
+        real_name: bytes,
+        parts: Tuple[bytes, ...],
     ) -> DNSQueryResult:
         """
         Do a query to Kube DNS for Kubernetes records only, fall back to
-        random DNS server if that fails.
+        random DNS server if that fails or is slow to answer.
+
+        :param parts: The labels of the query's name.
         """
-        new_query = deepcopy(query)
+        new_name = query.name.name
         if not query.name.name.endswith(b".local"):
             # Number of parts is used to guess the kind of input address, and
             # how to complete it
-            parts = query.name.name.split(b".")
             if len(parts) == 1:
                 # Only local service name is provided -> append namespace
-                parts.append(self.namespace.encode("ascii"))
+                parts += (self.namespace.encode("ascii"), )
             if len(parts) == 2:
                 # Service name and namespace provided
-                new_query.name.name = b".".join(parts) + b".svc.cluster.local"
+                new_name = b".".join(parts) + b".svc.cluster.local"
             elif parts[-1] == b"svc":
                 # xxx.svc provided (strimzi-kafka like)
-                new_query.name.name = b".".join(parts + [b"cluster.local"])
-
-        def fallback(err):
-            print(
-                "FAILED to lookup {} ({}), trying {}".
-                format(new_query.name.name, err, query.name.name)
-            )
-            return self.fallback.query(query, timeout=timeout)
+                new_name = b".".join(parts + (b"cluster.local", ))
+        new_query = clone_query(query, new_name)
 
         def fix_names(result):
-            # Make sure names in response match what the client asked format
-            for answer in result[0]:
-                answer.name = dns.Name(real_name)
-            print("RESULT: {}".format(result))
+            # Make sure names in response match what the client asked format.
+            # The records themselves were decoded from Kube DNS's answer and
+            # are used as they are. The answer may be shared with other
+            # queries for the same Kube DNS name, so rename copies of it:
+            answers, authority, additional = result
+            name = dns.Name(real_name)
+            renamed = []
+            for answer in answers:
+                answer = copy(answer)
+                answer.name = name
+                renamed.append(answer)
+            result = renamed, authority, additional
+            if DEBUG:
+                log.debug("RESULT: {result}", result=result)
             return result
 
-        print("RESOLVING {}".format(new_query.name.name))
-        # We expect Kube DNS to be fast, so have short timeout in case we need
-        # to fallback:
-        d = client.Resolver(servers=[(self.kubedns, 53)]).query(
-            new_query, timeout=[0.1]
+        def first_answer(result):
+            if isinstance(result, list):
+                # Neither succeeded, report why the fallback failed:
+                if DEBUG:
+                    log.debug(
+                        "FAILED to lookup {kube_name!r} ({kube.value}) and "
+                        "{name!r} ({fallback.value})",
+                        kube_name=new_query.name.name,
+                        kube=result[0][1],
+                        name=query.name.name,
+                        fallback=result[1][1],
+                    )
+                return result[1][1]
+            answer, index = result
+            racing[1 - index].cancel()
+            return answer
+
+        fallback_queries = []  # type: List[defer.Deferred]
+
+        def query_fallback():
+            if DEBUG:
+                log.debug(
+                    "No answer for {kube_name!r} yet, trying {name!r}",
+                    kube_name=new_query.name.name,
+                    name=query.name.name,
+                )
+            fallback_queries.append(
+                unshared(self.fallback.query(query, timeout=timeout))
+            )
+            fallback_queries[0].chainDeferred(fallback)
+
+        def cancel_fallback(_):
+            if delayed.active():
+                delayed.cancel()
+            for d in fallback_queries:
+                d.cancel()
+
+        def kube_failed(failure):
+            # Don't wait any longer before asking the fallback:
+            if delayed.active():
+                delayed.cancel()
+                query_fallback()
+            return failure
+
+        if DEBUG:
+            log.debug("RESOLVING {name!r}", name=new_query.name.name)
+        # We expect Kube DNS to be fast, so only ask the fallback nameserver
+        # if it hasn't answered after a short while. Kube DNS can still win
+        # after that, so its timeout only bounds how long we wait on it:
+        fallback = defer.Deferred(cancel_fallback)  # type: defer.Deferred
+        delayed = self._reactor.callLater(FALLBACK_DELAY, query_fallback)
+        kube = unshared(
+            self._kube_resolver.query(new_query, timeout=[0.5])
+        )
+        kube.addCallbacks(fix_names, kube_failed)
+        racing = [kube, fallback]
+        d = defer.DeferredList(
+            racing, fireOnOneCallback=True, consumeErrors=True
         )
-        d.addCallback(fix_names)
-        d.addErrback(fallback)
+        d.addCallback(first_answer)
         return d
 
     def _identify_sanity_check(self, real_name):
@@ -172,50 +625,131 @@ class LocalResolver(object):
             real_name.startswith(b"hellotelepresence")
             and real_name.endswith(b"telepresence.io")
         ):
-            print("Sanity check: {}".format(real_name))
+            log.info("Sanity check: {name!r}", name=real_name)
             return defer.fail(error.AuthoritativeDomainError("Sanity check"))
 
     def _identify_suffix_probe(self, real_name, parts):
         if parts[0].startswith(b"hellotelepresence"):
-            suffix = tuple(parts[1:])
+            suffix = parts[1:]
             if suffix not in self.suffixes:
                 # Insert the new suffix so that the list is sorted starting
                 # with longest suffixes.
                 insort(self.suffixes, suffix, lambda parts: -len(parts))
-                print("Set DNS suffix we filter out to: {}".format(
-                    self.suffixes
-                ))
+                node = self._suffix_trie
+                for label in reversed(suffix):
+                    node = node.setdefault(label, {})
+                node[_SUFFIX_END] = True
+                log.info(
+                    "Set DNS suffix we filter out to: {suffixes}",
+                    suffixes=self.suffixes,
+                )
             return self._got_ips(real_name, ["127.0.0.1"], dns.Record_A)
 
     def _strip_search_suffix(self, parts):
-        for suffix in self.suffixes:
-            if tuple(parts[-len(suffix):]) == suffix:
-                return parts[:-len(suffix)]
+        node = self._suffix_trie
+        depth = 0
+        for i, label in enumerate(reversed(parts), 1):
+            node = node.get(label)
+            if node is None:
+                break
+            if _SUFFIX_END in node:
+                # Keep going, longer suffixes win:
+                depth = i
+        if depth:
+            return parts[:-depth]
         return parts
 
     def _handle_search_suffix(self, query, parts, timeout):
         stem = self._strip_search_suffix(parts)
         if stem != parts:
-            new_query = deepcopy(query)
-            new_query.name.name = b".".join(stem)
-            print(
-                "Updated query of type {} from {} to {}".
-                format(query.type, query.name.name, new_query.name.name)
-            )
+            new_query = clone_query(query, b".".join(stem))
+            if DEBUG:
+                log.debug(
+                    "Updated query of type {type} from {name!r} to "
+                    "{new_name!r}",
+                    type=query.type,
+                    name=query.name.name,
+                    new_name=new_query.name.name,
+                )
 
             def failed(f):
-                print(
-                    "Failed to lookup {} due to {}, falling back to {}".
-                    format(new_query.name.name, f, query.name.name)
+                if DEBUG:
+                    log.debug(
+                        "Failed to lookup {new_name!r} due to {reason.value}, "
+                        "falling back to {name!r}",
+                        new_name=new_query.name.name,
+                        reason=f,
+                        name=query.name.name,
+                    )
+                return self.fallback.query(query, timeout=timeout)
+
+            # The stripped name needs no further special handling, so rather
+            # than going through query() again, resolve it directly:
+            if query.type == dns.A:
+                d = defer.maybeDeferred(
+                    self._query_a,
+                    new_query,
+                    timeout=(1, 1),
+                    real_name=query.name.name,
+                    parts=stem,
                 )
+            else:
+                d = self.fallback.query(new_query, timeout=(1, 1))
+            return d.addErrback(failed)
+
+    def _query_a(
+        self,
+        query: dns.Query,
+        timeout,
+        real_name: bytes,
+        parts: Tuple[bytes, ...],
+    ) -> DNSQueryResult:
+        """
+        Resolve an A query whose name has no search suffix left to strip.
+
+        :param parts: The labels of the query's name.
+        """
+        if DEBUG:
+            log.debug("A query: {name!r}", name=query.name.name)
+        # Apps probe their own pod IP and the like; there's nothing to
+        # look up for an IP address:
+        if len(parts) == 4 and isIPAddress(
+            query.name.name.decode("ascii", "replace")
+        ):
+            return self._got_ips(
+                real_name, [query.name.name.decode("ascii")], dns.Record_A
+            )
+        # sshuttle, which is running on client side, works by capturing DNS
+        # packets to name servers. If we're on a VM, non-Kubernetes domains
+        # like google.com won't be handled by Kube DNS and so will be
+        # forwarded to name servers that host defined... and then they will
+        # be recaptured by sshuttle (depending on how VM networkng is
+        # setup) which will send them back here and result in infinite loop
+        # of DNS queries. So we check Kube DNS in way that won't trigger
+        # that, and if that doesn't work query a name server that sshuttle
+        # doesn't know about.
+        if self.noloop:
+            # maybe be servicename, service.namespace, or something.local
+            # or service.anything.namespace.svc
+            # (.local is used for both services and pods). The name's
+            # already been split into labels, so check those rather than
+            # scanning the whole name again for each pattern:
+            if (
+                len(parts) <= 2 or parts[-1] == b"local"
+                or b"svc" in parts[1:]
+            ):
+                return self._no_loop_kube_query(
+                    query, timeout=timeout, real_name=real_name,
+                    parts=parts
+                )
+            else:
                 return self.fallback.query(query, timeout=timeout)
 
-            return defer.maybeDeferred(
-                self.query,
-                new_query,
-                timeout=(1, 1),
-                real_name=query.name.name,
-            ).addErrback(failed)
+        d = self._resolve(query.name.name, timeout)
+        d.addCallback(
+            lambda records: self._got_records(real_name, records)
+        ).addErrback(self._got_error)
+        return d
 
     def query(
         self,
@@ -228,13 +762,56 @@ class LocalResolver(object):
         if real_name is None:
             real_name = query.name.name
         assert isinstance(real_name, bytes), type(real_name)
+
+        if query.type == dns.AAAA and not (
+            b":" in query.name.name and isIPv6Address(
+                query.name.name.decode("ascii", "replace")
+            )
+        ):
+            # Kubernetes can't do IPv6, and if we return empty result OS X
+            # gives up (Happy Eyeballs algorithm, maybe?), so never return
+            # anything IPv6y. Instead return A records to pacify OS X. Those
+            # are cached as the answer to the A query, so both agree:
+            if DEBUG:
+                log.debug(
+                    "AAAA query, sending back A instead: {name!r}",
+                    name=query.name.name,
+                )
+            query.type = dns.A  # type: ignore
+
+        key = (query.type, query.name.name.lower())
+        result = self._cache_lookup(key, query, real_name)
+        if result is not None:
+            return result
+
+        waiters = self._inflight.get(key)
+        if waiters is not None:
+            waiter = defer.Deferred()  # type: defer.Deferred
+            waiters.append((waiter, real_name))
+            return waiter
+
+        result = self._query(query, timeout, real_name)
+        if isinstance(result, defer.Deferred):
+            result.addCallbacks(
+                self._cache_result,
+                self._cache_error,
+                callbackArgs=(key, real_name),
+                errbackArgs=(key, real_name),
+            )
+            self._inflight[key] = []
+            result.addBoth(self._wake_waiters, key, real_name)
+        return result
+
+    def _query(
+        self, query: dns.Query, timeout, real_name: bytes
+    ) -> DNSQueryResult:
         # We use a special marker hostname, which is always sent by
         # telepresence, to figure out the search suffix set by the client
         # machine's resolv.conf. We then remove it since it masks our ability
         # to add the Kubernetes suffixes. E.g. if DHCP sets 'search wework.com'
         # on the client machine we will want to lookup 'kubernetes' if we get
         # 'kubernetes.wework.com'.
-        parts = query.name.name.split(b".")
+        parts = tuple(query.name.name.split(b"."))
 
         result = self._identify_sanity_check(real_name)
         if result is not None:
@@ -250,45 +827,16 @@ class LocalResolver(object):
 
         # No special suffix:
         if query.type == dns.A:
-            print("A query: {}".format(query.name.name))
-            # sshuttle, which is running on client side, works by capturing DNS
-            # packets to name servers. If we're on a VM, non-Kubernetes domains
-            # like google.com won't be handled by Kube DNS and so will be
-            # forwarded to name servers that host defined... and then they will
-            # be recaptured by sshuttle (depending on how VM networkng is
-            # setup) which will send them back here and result in infinite loop
-            # of DNS queries. So we check Kube DNS in way that won't trigger
-            # that, and if that doesn't work query a name server that sshuttle
-            # doesn't know about.
-            if self.noloop:
-                # maybe be servicename, service.namespace, or something.local
-                # or service.anything.namespace.svc
-                # (.local is used for both services and pods):
-                if query.name.name.count(b".") in (
-                    0, 1
-                ) or query.name.name.endswith(
-                        b".local") or b".svc" in query.name.name:
-                    return self._no_loop_kube_query(
-                        query, timeout=timeout, real_name=real_name
-                    )
-                else:
-                    return self.fallback.query(query, timeout=timeout)
-
-            d = deferToThread(resolve, query.name.name)
-            d.addCallback(
-                lambda ips: self._got_ips(real_name, ips, dns.Record_A)
-            ).addErrback(self._got_error)
-            return d
+            return self._query_a(query, timeout, real_name, parts)
         elif query.type == dns.AAAA:
-            # Kubernetes can't do IPv6, and if we return empty result OS X
-            # gives up (Happy Eyeballs algorithm, maybe?), so never return
-            # anything IPv6y. Instead return A records to pacify OS X.
-            print(
-                "AAAA query, sending back A instead: {}".
-                format(query.name.name)
-            )
-            query.type = dns.A  # type: ignore
-            return self.query(query, timeout=timeout, real_name=real_name)
+            # query() only passes on AAAA queries for IPv6 addresses, which
+            # have no A record and nothing to look up:
+            return [], [], []
         else:
-            print("{} query: {}".format(query.type, query.name.name))
+            if DEBUG:
+                log.debug(
+                    "{type} query: {name!r}",
+                    type=query.type,
+                    name=query.name.name,
+                )
             return self.fallback.query(query, timeout=timeout)
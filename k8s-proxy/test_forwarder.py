@@ -118,3 +118,16 @@ def test_insort(values):
         insort(insort_target, v, key=lambda v: -v)
 
     assert sorted(values, reverse=True) == insort_target
+
+
+@given(st.lists(st.tuples(st.integers(0, 3), st.integers())))
+def test_insort_stable(values):
+    """
+    ``insort`` inserts a new element after any existing elements with the same
+    key.
+    """
+    insort_target = []
+    for v in values:
+        insort(insort_target, v, key=lambda v: v[0])
+
+    assert sorted(values, key=lambda v: v[0]) == insort_target
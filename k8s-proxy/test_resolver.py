@@ -1,50 +1,150 @@
+from typing import Any, List
+
 import pytest
 
-from twisted.names import dns
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.names import dns, error
 from unittest import mock
 
-from resolver import LocalResolver
+import resolver as resolver_module
+from resolver import (
+    FALLBACK_DELAY,
+    LocalResolver,
+    _NXDOMAIN,
+    get_hosts_addresses,
+    get_resolv_conf_namservers,
+    get_resolv_conf_search,
+)
 
 
 @pytest.fixture
 def resolver():
-    return LocalResolver("8.8.8.8", "my-ns")
+    resolver = LocalResolver("8.8.8.8", "my-ns", reactor=Clock())
+    # Don't send queries to real nameservers:
+    resolver._kube_resolver = mock.Mock()
+    resolver.fallback = mock.Mock()
+    return resolver
+
+
+def a_answer(name, address, ttl=0, record_ttl=None):
+    """
+    Return an answer for ``name`` with an A record of ``address``.
+    """
+    return dns.RRHeader(
+        name=name, payload=dns.Record_A(address, ttl=record_ttl), ttl=ttl
+    )
+
+
+def answer_now(resolver: LocalResolver, name: str, type: int = dns.A) -> Any:
+    """
+    Return the answer ``resolver`` has already got for a query of ``name``,
+    or the ``Failure`` it failed with.
+    """
+    results: List[Any] = []
+    defer.maybeDeferred(resolver.query, dns.Query(name, type)).addBoth(
+        results.append
+    )
+    return results[0]
+
+
+def test_resolv_conf(tmpdir, monkeypatch):
+    """
+    /etc/resolv.conf is parsed again only once it's been modified.
+    """
+    resolv_conf = tmpdir.join("resolv.conf")
+    resolv_conf.write(
+        "# comment\n"
+        "Nameserver 10.0.0.10\n"
+        "search my-ns.svc.cluster.local svc.cluster.local\n"
+        "options ndots:5\n"
+    )
+    resolv_conf.setmtime(1000)
+    monkeypatch.setattr(resolver_module, "RESOLV_CONF_PATH", str(resolv_conf))
+    assert get_resolv_conf_namservers() == ["10.0.0.10"]
+    assert get_resolv_conf_search() == (
+        [b"my-ns.svc.cluster.local", b"svc.cluster.local"], 5
+    )
+
+    resolv_conf.write("nameserver 10.0.0.11\ndomain example.com\n")
+    resolv_conf.setmtime(2000)
+    assert get_resolv_conf_namservers() == ["10.0.0.11"]
+    assert get_resolv_conf_search() == ([b"example.com"], 1)
+
+
+def test_close(tmpdir, monkeypatch):
+    """
+    ``LocalResolver.close`` stops the fallback resolver from re-reading
+    /etc/resolv.conf.
+    """
+    resolv_conf = tmpdir.join("resolv.conf")
+    resolv_conf.write("nameserver 10.0.0.10\n")
+    monkeypatch.setattr(resolver_module, "RESOLV_CONF_PATH", str(resolv_conf))
+    clock = Clock()
+    local_resolver = LocalResolver(None, "my-ns", reactor=clock)
+    assert clock.getDelayedCalls()
+    local_resolver.close()
+    assert clock.getDelayedCalls() == []
+
+
+def test_hosts(tmpdir, monkeypatch):
+    """
+    /etc/hosts is parsed again only once it's been modified, and only its
+    IPv4 addresses are used.
+    """
+    hosts = tmpdir.join("hosts")
+    hosts.write(
+        "127.0.0.1 localhost # comment\n"
+        "::1 localhost\n"
+        "10.0.0.5 my-pod My-Pod.my-ns.pod\n"
+        "10.0.0.6 my-pod\n"
+    )
+    hosts.setmtime(1000)
+    monkeypatch.setattr(resolver_module, "HOSTS_PATH", str(hosts))
+    assert get_hosts_addresses(b"localhost") == ("127.0.0.1", )
+    assert get_hosts_addresses(b"MY-POD") == ("10.0.0.5", "10.0.0.6")
+    assert get_hosts_addresses(b"my-pod.my-ns.pod") == ("10.0.0.5", )
+    assert get_hosts_addresses(b"comment") == ()
+
+    hosts.write("10.0.0.7 my-pod\n")
+    hosts.setmtime(2000)
+    assert get_hosts_addresses(b"my-pod") == ("10.0.0.7", )
+
+    hosts.remove()
+    assert get_hosts_addresses(b"my-pod") == ()
 
 
 class TestLocalResolver:
     @staticmethod
-    @mock.patch("resolver.client")
-    def test_query_service(client_mock: mock.Mock, resolver: LocalResolver):
+    def test_query_service(resolver: LocalResolver):
         """
         Service name must be completed with namespace and .svc.cluster.local.
         """
         query = dns.Query("my-service")
         resolver.query(query)
-        client_mock.Resolver.return_value.query.assert_called_with(
+        resolver._kube_resolver.query.assert_called_with(
             dns.Query("my-service.my-ns.svc.cluster.local", dns.A, mock.ANY),
             timeout=mock.ANY,
         )
 
     @staticmethod
-    @mock.patch("resolver.client")
-    def test_query_service_ns(client_mock: mock.Mock, resolver: LocalResolver):
+    def test_query_service_ns(resolver: LocalResolver):
         """
         Service name + namespace must be completed with .svc.cluster.local.
         """
         query = dns.Query("service.given-ns")
         resolver.query(query)
-        client_mock.Resolver.return_value.query.assert_called_with(
+        resolver._kube_resolver.query.assert_called_with(
             dns.Query("service.given-ns.svc.cluster.local", dns.A, mock.ANY),
             timeout=mock.ANY,
         )
 
     @staticmethod
-    @mock.patch("resolver.client")
-    def test_query_svc(client_mock: mock.Mock, resolver: LocalResolver):
+    def test_query_svc(resolver: LocalResolver):
         """.svc host must be completed with .cluster.local."""
         query = dns.Query("some-pod.my-service.ns.svc")
         resolver.query(query)
-        client_mock.Resolver.return_value.query.assert_called_with(
+        resolver._kube_resolver.query.assert_called_with(
             dns.Query(
                 "some-pod.my-service.ns.svc.cluster.local", dns.A, mock.ANY
             ),
@@ -52,11 +152,460 @@ class TestLocalResolver:
         )
 
     @staticmethod
-    @mock.patch("resolver.client")
-    def test_query_local(client_mock: mock.Mock, resolver: LocalResolver):
+    def test_query_local(resolver: LocalResolver):
         """.local host must be left un-touched."""
         query = dns.Query("leave-me.local")
         resolver.query(query)
-        client_mock.Resolver.return_value.query.assert_called_with(
+        resolver._kube_resolver.query.assert_called_with(
             dns.Query("leave-me.local", dns.A, mock.ANY), timeout=mock.ANY
         )
+
+    @staticmethod
+    def test_query_cached(resolver: LocalResolver):
+        """
+        Repeated queries are answered from the cache, renamed to match the
+        query.
+        """
+        kube_query = resolver._kube_resolver.query
+        kube_query.return_value = defer.succeed(([
+            a_answer("my-service.my-ns.svc.cluster.local", "10.0.0.1", ttl=30)
+        ], [], []))
+        first = answer_now(resolver, "my-service")
+        # Cached answers are returned as they are, not in a Deferred:
+        second = resolver.query(dns.Query("MY-SERVICE"))
+        assert isinstance(second, tuple)
+        assert kube_query.call_count == 1
+        assert [answer.name for answer in first[0]] == [dns.Name("my-service")]
+        assert [answer.name for answer in second[0]] == [
+            dns.Name("MY-SERVICE")
+        ]
+        assert second[0][0].payload == first[0][0].payload
+
+    @staticmethod
+    def test_query_shared_kube_answer(resolver: LocalResolver):
+        """
+        Names that map to the same Kube DNS name can be given the same
+        answer by the Kube DNS client; each gets its own renamed copy.
+        """
+        kube_query = resolver._kube_resolver.query
+        pending: List[defer.Deferred] = [defer.Deferred(), defer.Deferred()]
+        kube_query.side_effect = pending
+        results: List[Any] = []
+        for name in ["my-service", "my-service.my-ns"]:
+            defer.maybeDeferred(resolver.query, dns.Query(name)).addCallback(
+                results.append
+            )
+        kube_name = dns.Name("my-service.my-ns.svc.cluster.local")
+        shared: Any = ([a_answer(kube_name.name, "10.0.0.1")], [], [])
+        for d in pending:
+            d.callback(shared)
+        assert shared[0][0].name == kube_name
+        assert [result[0][0].name for result in results] == [
+            dns.Name("my-service"),
+            dns.Name("my-service.my-ns"),
+        ]
+        for name in ["my-service", "my-service.my-ns"]:
+            assert answer_now(resolver, name)[0][0].name == dns.Name(name)
+        assert kube_query.call_count == 2
+
+    @staticmethod
+    def test_query_cached_refresh(resolver: LocalResolver):
+        """
+        A cached answer that's used late in its TTL is refreshed in the
+        background, once, while the cached answer is returned meanwhile.
+        """
+        kube_query = resolver._kube_resolver.query
+
+        def answer(address):
+            return defer.succeed(([
+                a_answer(
+                    "my-service.my-ns.svc.cluster.local", address, ttl=100
+                )
+            ], [], []))
+
+        kube_query.return_value = answer("10.0.0.1")
+        with mock.patch("resolver.time.monotonic", return_value=1000):
+            answer_now(resolver, "my-service")
+        kube_query.return_value = answer("10.0.0.2")
+        with mock.patch("resolver.time.monotonic", return_value=1090):
+            for _ in range(2):
+                result = answer_now(resolver, "my-service")
+                assert result[0][0].payload.dottedQuad() == "10.0.0.1"
+            assert kube_query.call_count == 1
+            resolver._reactor.advance(0)
+            assert kube_query.call_count == 2
+        with mock.patch("resolver.time.monotonic", return_value=1150):
+            result = answer_now(resolver, "my-service")
+        assert result[0][0].payload.dottedQuad() == "10.0.0.2"
+        assert result[0][0].name == dns.Name("my-service")
+        assert kube_query.call_count == 2
+        assert resolver._inflight == {}
+
+    @staticmethod
+    def test_query_aaaa_cached_refresh(resolver: LocalResolver):
+        """
+        AAAA queries are answered with the A query's cached answer, so they
+        see its refreshes too.
+        """
+        kube_query = resolver._kube_resolver.query
+
+        def answer(address):
+            return defer.succeed(([
+                a_answer(
+                    "my-service.my-ns.svc.cluster.local", address, ttl=100
+                )
+            ], [], []))
+
+        kube_query.return_value = answer("10.0.0.1")
+        with mock.patch("resolver.time.monotonic", return_value=1000):
+            answer_now(resolver, "my-service", dns.AAAA)
+        kube_query.return_value = answer("10.0.0.2")
+        with mock.patch("resolver.time.monotonic", return_value=1090):
+            result = answer_now(resolver, "my-service", dns.AAAA)
+            assert result[0][0].payload.dottedQuad() == "10.0.0.1"
+            resolver._reactor.advance(0)
+        with mock.patch("resolver.time.monotonic", return_value=1150):
+            for type in [dns.A, dns.AAAA]:
+                result = answer_now(resolver, "my-service", type)
+                assert result[0][0].payload.dottedQuad() == "10.0.0.2"
+        assert kube_query.call_count == 2
+
+    @staticmethod
+    def test_query_waits_for_refresh(resolver: LocalResolver):
+        """
+        A query that misses the cache while its entry is being refreshed
+        waits for the refresh rather than starting another lookup.
+        """
+        kube_query = resolver._kube_resolver.query
+        kube_name = "my-service.my-ns.svc.cluster.local"
+        kube_query.return_value = defer.succeed((
+            [a_answer(kube_name, "10.0.0.1", ttl=100)], [], []
+        ))
+        with mock.patch("resolver.time.monotonic", return_value=1000):
+            answer_now(resolver, "my-service")
+        pending: defer.Deferred = defer.Deferred()
+        kube_query.return_value = pending
+        with mock.patch("resolver.time.monotonic", return_value=1090):
+            answer_now(resolver, "my-service")
+            resolver._reactor.advance(0)
+        results: List[Any] = []
+        with mock.patch("resolver.time.monotonic", return_value=1200):
+            defer.maybeDeferred(
+                resolver.query, dns.Query("My-Service")
+            ).addBoth(results.append)
+        assert results == []
+        assert kube_query.call_count == 2
+
+        pending.callback(([a_answer(kube_name, "10.0.0.2", ttl=100)], [], []))
+        assert results[0][0][0].payload.dottedQuad() == "10.0.0.2"
+        assert results[0][0][0].name == dns.Name("My-Service")
+        assert resolver._inflight == {}
+
+    @staticmethod
+    def test_query_negative_cached(resolver: LocalResolver):
+        """Names that don't exist are remembered as such."""
+        resolver.fallback.query.return_value = defer.fail(
+            error.DNSNameError()
+        )
+        for _ in range(2):
+            result = answer_now(resolver, "nothing.example.com")
+            assert result.check(error.DomainError)
+        assert resolver.fallback.query.call_count == 1
+
+    @staticmethod
+    def test_query_servfail_cached(resolver: LocalResolver):
+        """
+        Names the nameserver failed to resolve are remembered as such, but
+        timeouts aren't.
+        """
+        resolver.fallback.query.side_effect = lambda *a, **kw: defer.fail(
+            error.DNSServerError()
+        )
+        for _ in range(2):
+            result = answer_now(resolver, "broken.example.com")
+            assert result.check(error.DNSServerError)
+        assert resolver.fallback.query.call_count == 1
+
+        resolver.fallback.query.side_effect = lambda *a, **kw: defer.fail(
+            error.DNSQueryTimeoutError(None)
+        )
+        for _ in range(2):
+            result = answer_now(resolver, "slow.example.com")
+            assert result.check(error.DNSQueryTimeoutError)
+        assert resolver.fallback.query.call_count == 3
+
+    @staticmethod
+    def test_cache_full(resolver: LocalResolver, monkeypatch):
+        """
+        When the cache is full, expired entries are dropped, then the oldest
+        ones, to make room for a batch of new entries.
+        """
+        monkeypatch.setattr(resolver_module, "CACHE_MAX_ENTRIES", 20)
+        monkeypatch.setattr(resolver_module, "CACHE_PURGE_ENTRIES", 5)
+        with mock.patch("resolver.time.monotonic", return_value=1000):
+            for i in range(20):
+                resolver._cache_store(
+                    (dns.A, b"%d" % i), 10 if i < 10 else 100, _NXDOMAIN, b""
+                )
+        with mock.patch("resolver.time.monotonic", return_value=1050):
+            resolver._cache_store((dns.A, b"new"), 100, _NXDOMAIN, b"")
+            assert len(resolver._cache) == 11
+            for i in range(9):
+                resolver._cache_store(
+                    (dns.A, b"more%d" % i), 100, _NXDOMAIN, b""
+                )
+            # Full of live entries, the oldest are dropped:
+            resolver._cache_store((dns.A, b"last"), 100, _NXDOMAIN, b"")
+        assert len(resolver._cache) == 16
+        assert (dns.A, b"14") not in resolver._cache
+        assert (dns.A, b"15") in resolver._cache
+        assert (dns.A, b"last") in resolver._cache
+
+    @staticmethod
+    def test_query_coalesced(resolver: LocalResolver):
+        """
+        Queries for a name that is already being resolved wait for that
+        resolution instead of starting another one.
+        """
+        kube_query = resolver._kube_resolver.query
+        pending: defer.Deferred = defer.Deferred()
+        kube_query.return_value = pending
+        results: List[Any] = []
+        for name in ["my-service", "my-service", "My-Service"]:
+            defer.maybeDeferred(resolver.query, dns.Query(name)).addCallback(
+                results.append
+            )
+        assert kube_query.call_count == 1
+        assert results == []
+
+        pending.callback(([
+            a_answer("my-service.my-ns.svc.cluster.local", "10.0.0.1")
+        ], [], []))
+        assert [result[0][0].name for result in results] == [
+            dns.Name("my-service"),
+            dns.Name("my-service"),
+            dns.Name("My-Service"),
+        ]
+        assert resolver._inflight == {}
+
+    @staticmethod
+    @mock.patch("resolver.client")
+    def test_resolve_search(client_mock: mock.Mock):
+        """
+        Without a telepresence nameserver, A queries are resolved applying the
+        search domains and ndots the way the pod's libc would.
+        """
+        resolver = LocalResolver(None, "my-ns")
+        resolver.search = [b"my-ns.svc.cluster.local", b"cluster.local"]
+        resolver.ndots = 5
+
+        def lookup(name, timeout):
+            if name != b"db.other-ns.svc.cluster.local":
+                return defer.fail(error.DNSNameError(name))
+            return defer.succeed(([
+                a_answer(name, "10.0.0.2", record_ttl=300)
+            ], [], []))
+
+        resolver.fallback.lookupAddress.side_effect = lookup
+        result = answer_now(resolver, "db.other-ns.svc")
+        assert [answer.payload.dottedQuad() for answer in result[0]] == [
+            "10.0.0.2"
+        ]
+        assert result[0][0].name == dns.Name("db.other-ns.svc")
+        # The record is used as it is, with its TTL:
+        assert result[0][0].ttl == 300
+        lookup_calls = resolver.fallback.lookupAddress.call_args_list
+        assert [call[0][0] for call in lookup_calls] == [
+            b"db.other-ns.svc.my-ns.svc.cluster.local",
+            b"db.other-ns.svc.cluster.local",
+        ]
+
+    @staticmethod
+    @mock.patch("resolver.client")
+    def test_resolve_errors_cached(client_mock: mock.Mock):
+        """
+        Without a telepresence nameserver, names that don't exist or whose
+        nameserver failed are remembered as such, but timeouts aren't
+        mistaken for either.
+        """
+        resolver = LocalResolver(None, "my-ns", reactor=Clock())
+        resolver.search = []
+        resolver.ndots = 1
+        lookup = resolver.fallback.lookupAddress
+        for failure, reported, cached in [
+            (error.DNSNameError, error.DomainError, True),
+            (error.DNSServerError, error.DNSServerError, True),
+            (error.DNSQueryTimeoutError, error.DNSQueryTimeoutError, False),
+        ]:
+            lookup.reset_mock()
+            lookup.side_effect = lambda *a, **kw: defer.fail(failure(None))
+            name = "%s.example.com" % (failure.__name__, )
+            for _ in range(3):
+                assert answer_now(resolver, name).check(reported)
+            assert lookup.call_count == (1 if cached else 3)
+
+    @staticmethod
+    @mock.patch("resolver.client")
+    def test_refresh_failed(client_mock: mock.Mock):
+        """
+        A cached answer is kept if refreshing it times out or fails, and is
+        only replaced if the name no longer exists.
+        """
+        resolver = LocalResolver(None, "my-ns", reactor=Clock())
+        resolver.search = []
+        resolver.ndots = 1
+        lookup = resolver.fallback.lookupAddress
+        lookup.return_value = defer.succeed(([
+            a_answer("db.example.com", "1.2.3.4", record_ttl=100)
+        ], [], []))
+        with mock.patch("resolver.time.monotonic", return_value=1000):
+            answer_now(resolver, "db.example.com")
+        for now, failure in [
+            (1090, error.DNSQueryTimeoutError),
+            (1091, error.DNSServerError),
+        ]:
+            lookup.side_effect = lambda *a, **kw: defer.fail(failure(None))
+            with mock.patch("resolver.time.monotonic", return_value=now):
+                answer_now(resolver, "db.example.com")
+                resolver._reactor.advance(0)
+                result = answer_now(resolver, "db.example.com")
+            assert result[0][0].payload.dottedQuad() == "1.2.3.4"
+
+        lookup.side_effect = lambda *a, **kw: defer.fail(
+            error.DNSNameError(None)
+        )
+        with mock.patch("resolver.time.monotonic", return_value=1092):
+            resolver._reactor.advance(0)
+            result = answer_now(resolver, "db.example.com")
+        assert result.check(error.DomainError)
+        assert lookup.call_count == 4
+
+    @staticmethod
+    def test_query_slow_kube(resolver: LocalResolver):
+        """
+        If Kube DNS is slow to answer, the fallback nameserver is queried as
+        well and the first answer wins.
+        """
+        kube_query = resolver._kube_resolver.query
+        cancel_kube = mock.Mock()
+        kube_query.return_value = defer.Deferred(cancel_kube)
+        resolver.fallback.query.return_value = defer.succeed(([
+            a_answer("example.local", "10.0.0.3")
+        ], [], []))
+        results: List[Any] = []
+        query = dns.Query("example.local")
+        defer.maybeDeferred(resolver.query, query).addCallback(results.append)
+        assert not resolver.fallback.query.called
+
+        resolver._reactor.advance(FALLBACK_DELAY)
+        resolver.fallback.query.assert_called_with(
+            dns.Query("example.local"), timeout=None
+        )
+        assert results[0][0][0].payload == dns.Record_A("10.0.0.3")
+        # The loser's lookup may be shared with other queries, so it's left
+        # to finish:
+        assert not cancel_kube.called
+
+    @staticmethod
+    def test_query_shared_kube_lookup(resolver: LocalResolver):
+        """
+        When the fallback nameserver answers first for one name, a Kube DNS
+        lookup it shares with another name still answers the other name.
+        """
+        # Like client.Resolver, the second lookup of a name waits for the
+        # first one:
+        cancel_kube = mock.Mock()
+        shared: defer.Deferred = defer.Deferred(cancel_kube)
+        waiter: defer.Deferred = defer.Deferred()
+
+        def wake_waiter(result):
+            waiter.callback(result)
+            return result
+
+        shared.addBoth(wake_waiter)
+        resolver._kube_resolver.query.side_effect = [shared, waiter]
+
+        def fallback_query(query, timeout):
+            if query.name.name == b"my-service":
+                return defer.succeed(([
+                    a_answer("my-service", "10.0.0.3")
+                ], [], []))
+            return defer.Deferred()
+
+        resolver.fallback.query.side_effect = fallback_query
+        results: List[Any] = []
+        for name in ["my-service", "my-service.my-ns"]:
+            defer.maybeDeferred(resolver.query, dns.Query(name)).addBoth(
+                results.append
+            )
+        resolver._reactor.advance(FALLBACK_DELAY)
+        assert not cancel_kube.called
+        kube_name = "my-service.my-ns.svc.cluster.local"
+        shared.callback(([a_answer(kube_name, "10.0.0.1")], [], []))
+        assert [result[0][0].payload.dottedQuad() for result in results] == [
+            "10.0.0.3", "10.0.0.1"
+        ]
+        assert answer_now(resolver, "my-service.my-ns")[0][0].name == dns.Name(
+            "my-service.my-ns"
+        )
+
+    @staticmethod
+    def test_query_kube_failed(resolver: LocalResolver):
+        """
+        If Kube DNS fails, the fallback nameserver is queried straight away.
+        """
+        kube_query = resolver._kube_resolver.query
+        kube_query.return_value = defer.fail(error.DNSNameError())
+        resolver.fallback.query.return_value = defer.succeed(([
+            a_answer("example.local", "10.0.0.3")
+        ], [], []))
+        result = answer_now(resolver, "example.local")
+        assert result[0][0].payload == dns.Record_A("10.0.0.3")
+        assert resolver._reactor.getDelayedCalls() == []
+
+    @staticmethod
+    def test_query_search_suffix(resolver: LocalResolver):
+        """
+        Search suffixes discovered by probes are stripped before the name is
+        completed, and the answer is for the name that was asked.
+        """
+        answer_now(resolver, "hellotelepresence-0.wework.com")
+        kube_query = resolver._kube_resolver.query
+        kube_query.return_value = defer.succeed(([
+            a_answer("my-service.my-ns.svc.cluster.local", "10.0.0.1")
+        ], [], []))
+        result = answer_now(resolver, "my-service.wework.com")
+        kube_query.assert_called_with(
+            dns.Query("my-service.my-ns.svc.cluster.local", dns.A, dns.IN),
+            timeout=mock.ANY,
+        )
+        assert result[0][0].name == dns.Name("my-service.wework.com")
+
+    @staticmethod
+    def test_query_ip_address(resolver: LocalResolver):
+        """
+        IP addresses are answered without querying any nameservers.
+        """
+        result = answer_now(resolver, "10.0.0.4")
+        assert [answer.payload for answer in result[0]] == [
+            dns.Record_A("10.0.0.4")
+        ]
+        result = defer.maybeDeferred(
+            resolver.query, dns.Query("fd00::1", dns.AAAA)
+        ).result
+        assert result == ([], [], [])
+        assert not resolver._kube_resolver.query.called
+        assert not resolver.fallback.query.called
+
+    @staticmethod
+    def test_query_not_kube(resolver: LocalResolver):
+        """
+        Names which can't be Kubernetes names only go to the fallback
+        nameserver.
+        """
+        for name in ["www.example.com", "api.svcs.example.com", "svc.a.com"]:
+            resolver.query(dns.Query(name))
+            resolver.fallback.query.assert_called_with(
+                dns.Query(name), timeout=None
+            )
+        assert not resolver._kube_resolver.query.called